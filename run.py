@@ -10,11 +10,12 @@
 ####################################################################
 
 import argparse
+import logging
 from datetime import date
 from os.path import abspath, exists, join
 from os import makedirs
 
-from src.data_functions import CovidData
+from src.data_functions import CovidData, Request
 from src.plotting import plot_results
 
 # Function that processes input csv and generates list of rquests.
@@ -25,26 +26,26 @@ def get_requests(input_path: str) -> list:
     if not exists(input_path):
         raise RuntimeError("Input file does not exist: %s" %input_path)
 
-    # Read each line and store requests info in dictionary.
+    # Read each line and store the info of each request.
     requests = []
     with open(input_path, 'r') as f:
         # Skip header:
-        line = f.readline()
-        line = f.readline().rstrip()
-        while line:
+        next(f, None)
+        for linenum, line in enumerate(f, 2):
+            # Skip empty lines (eg. at the end of the file).
+            line = line.rstrip()
+            if not line:
+                continue
             try:
                 county, state, dist = line.split(',')
                 # Make sure distance is < 1000 miles as required.
                 if float(dist) > 1000.0:
                     raise ValueError("Distance must be < 1000 [miles].")
 
-                # Append result to list of dicts.
-                requests.append({'state': state,
-                                 'county': county,
-                                 'distance': float(dist)})
+                # Append result to list of requests.
+                requests.append(Request(county, state, float(dist)))
             except Exception as err:
-                raise RuntimeError("Invalid input data: %s" %err)
-            line = f.readline().rstrip()
+                raise RuntimeError("Invalid input data on line %d: %s" %(linenum, err))
     return requests
 
 # Main function
@@ -123,9 +124,20 @@ def main():
                         help='Path to input csv file.',
                         required=True)
     
+    # Optionally print details about every county found for each request.
+    parser.add_argument('-v', '--verbose',
+                        dest='verbose',
+                        action='store_true',
+                        help='Print every county found within range of each request.',
+                        required=False)
+
     # Parse the command line arguments.
     args = parser.parse_args()
 
+    # Details are logged at debug level, which is only shown in verbose mode.
+    logging.basicConfig(format='%(message)s',
+                        level=logging.DEBUG if args.verbose else logging.WARNING)
+
     # If output path for images does not exist, make the dir
     if args.save_path:
         if not exists(args.save_path):
@@ -146,15 +158,14 @@ def main():
     # Get list of requests
     requests = get_requests(args.input_path)
     
-    # Create COVID-19 Data object and load data from csv files.
-    data = CovidData(args.counties_data, args.geocodes,
-                     target_date)
-
-    # For each request obtained from the input file, calculate the
-    # results and append it to a list of results
-    results = []
-    for request in requests:
-        results.append(data.compute_stats(request, args.statistic))
+    # Create COVID-19 Data object and load data from csv files, with only
+    # the requested statistic.
+    data = CovidData(args.counties_data, args.geocodes, target_date,
+                     [args.statistic])
+
+    # Calculate the results of every request obtained from the input file
+    # (all at once, which is faster than one request at a time).
+    results = data.compute_stats_batch(requests, args.statistic)
 
     # Plot result using plotly county-choropleth
     plot_results(results, args.statistic, target_date, args.save_path)
@@ -6,25 +6,213 @@
 #    Functions related to loading and processing COVID-19 data.    #
 ####################################################################
 
+import csv
+import logging
+import math
+from dataclasses import dataclass
 from datetime import date
+from functools import lru_cache
+import glob
+from hashlib import md5
+import os
+import pickle
+import tempfile
 
-from os.path import exists
+from os.path import basename, dirname, exists
+
+import numpy as np
+import pandas as pd
 
 from src.us_states import us_state_abbrev
-from src.haversine import haversine
+from src.haversine import (haversine_term, haversine_term_to_miles,
+                           miles_to_haversine_term)
+
+logger = logging.getLogger(__name__)
+
+# Earth radius in miles (6371 km and 1.60934 [km/mi]), the same as in the
+# haversine formula. Distances divided by it are angles in radians.
+EARTH_RADIUS_MI = 6371.0/1.60934
+
+# Optional: scikit-learn's BallTree can find the counties within range of
+# many requests without computing the distance to every county. It is only
+# imported when a tree is built (see CovidData.tree_min_counties), as importing
+# scikit-learn takes ~1 s. Returns None if it is not installed.
+@lru_cache(maxsize=None)
+def import_ball_tree():
+    try:
+        from sklearn.neighbors import BallTree
+    except ImportError:
+        return None
+    return BallTree
+
+# Optional: without a BallTree, the counties within range can be found by a
+# numba compiled loop instead of the numpy expressions. It is only imported
+# the first time it is needed, as importing numba takes ~0.2 s.
+# Returns None if numba is not installed.
+@lru_cache(maxsize=None)
+def import_find_in_range_numba():
+    try:
+        from src.haversine_numba import find_in_range_numba
+    except ImportError:
+        return None
+    return find_in_range_numba
+
+# Optional: pyarrow's csv reader is a faster (multithreaded) alternative to
+# the pandas one, and is also used to write the cache files below as parquet.
+try:
+    import pyarrow as pa
+    from pyarrow import csv as pacsv
+except ImportError:
+    pacsv = None
+
+# Function to read the columns of a csv file listed in dtypes (column name
+# to type) into a DataFrame. Text (str or 'category') columns are kept exactly
+# as they appear in the file, and empty cells of numeric columns are missing
+# (NaN). Rows with the wrong number of columns are skipped with a warning.
+def read_csv(csv_path: str, dtypes: dict) -> pd.DataFrame:
+    numeric = [column for column, dtype in dtypes.items()
+               if dtype not in (str, 'category')]
+
+    # Output a warning about a line that will be skipped.
+    def warn_skip(expected_columns: int, actual_columns: int, text: str) -> None:
+        print("Warning: Expected %d columns, found %d" %(expected_columns,
+                                                         actual_columns))
+        print("Skipping line: %s" %text)
+
+    if pacsv is None:
+        # pandas fills missing values into rows with too few columns instead
+        # of reporting them, so first find the rows with the wrong number of
+        # columns, and then skip them when parsing.
+        skip = []
+        with open(csv_path, 'r', newline='') as f:
+            reader = csv.reader(f)
+            num_columns = len(next(reader, []))
+            for row in reader:
+                if row and len(row) != num_columns:
+                    warn_skip(num_columns, len(row), ','.join(row))
+                    skip.append(reader.line_num - 1)
+        return pd.read_csv(csv_path, usecols=list(dtypes), dtype=dtypes,
+                           keep_default_na=False,
+                           na_values={column: [''] for column in numeric},
+                           skiprows=skip)
+
+    def skip_row(row) -> str:
+        warn_skip(row.expected_columns, row.actual_columns, row.text)
+        return 'skip'
+
+    # Categorical columns are read as dictionary encoded strings, which
+    # become categorical columns in pandas.
+    column_types = {}
+    for column, dtype in dtypes.items():
+        if dtype is str:
+            column_types[column] = pa.string()
+        elif dtype == 'category':
+            column_types[column] = pa.dictionary(pa.int32(), pa.string())
+        else:
+            column_types[column] = pa.from_numpy_dtype(np.dtype(dtype))
+    table = pacsv.read_csv(csv_path,
+                           parse_options=pacsv.ParseOptions(invalid_row_handler=skip_row),
+                           convert_options=pacsv.ConvertOptions(include_columns=list(dtypes),
+                                                                column_types=column_types,
+                                                                null_values=[''],
+                                                                strings_can_be_null=False))
+    return table.to_pandas()
+
+# Function to read a csv file as above, with caching.
+# Parsing the csv files is the slowest part of loading the data, so the parsed
+# DataFrame is kept in memory for other CovidData objects created by the same
+# process (e.g. the unit tests), and is also saved to a cache file beside the
+# csv and read from there by later runs.
+# Both are only used as long as the csv has not been modified since (same
+# modification time and size).
+# The returned DataFrame is a shallow copy of the cached one, so replacing its
+# columns does not change the cache (but modifying them in place would).
+def read_csv_cached(csv_path: str, dtypes: dict) -> pd.DataFrame:
+    csv_stat = os.stat(csv_path)
+    df = _read_csv_cached(csv_path, csv_stat.st_mtime_ns, csv_stat.st_size,
+                          tuple(dtypes.items()))
+    return df.copy(deep=False)
+
+# The cache file name includes a hash of the columns and types, so csv files
+# (or requests) with different columns/types never share a cache file, and a
+# hash of the csv modification time and size, so a modified csv (even one
+# replaced by an older copy) never uses the cache file of another version.
+# The cache is a parquet file if pyarrow is installed, otherwise a pickle file.
+@lru_cache(maxsize=8)
+def _read_csv_cached(csv_path: str, csv_mtime_ns: int, csv_size: int,
+                     dtypes: tuple) -> pd.DataFrame:
+    dtypes = dict(dtypes)
+    options_hash = md5(repr(dtypes).encode()).hexdigest()[:8]
+    version_hash = md5(repr((csv_mtime_ns, csv_size)).encode()).hexdigest()[:8]
+    extension = 'parquet' if pacsv is not None else 'pkl'
+    cache_path = '%s.%s.%s.%s' %(csv_path, options_hash, version_hash, extension)
+
+    if exists(cache_path):
+        try:
+            if pacsv is not None:
+                return pd.read_parquet(cache_path, memory_map=True)
+            return pd.read_pickle(cache_path)
+        except Exception as err:
+            # Any file that can't be read (e.g. one left empty by an
+            # interrupted write) is replaced below.
+            print("Warning: Could not read cache file %s: %s" %(cache_path, err))
+
+    df = read_csv(csv_path, dtypes)
+    try:
+        write_cache_file(df, cache_path)
+    except (ImportError, OSError):
+        # Caching is optional, continue without it.
+        return df
+
+    # Remove the cache files of other versions of the csv (and those named
+    # without a version).
+    for path in glob.glob('%s.%s*.%s' %(glob.escape(csv_path), options_hash,
+                                         extension)):
+        if path != cache_path:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+    return df
+
+# Function to write a DataFrame to a cache file (parquet if pyarrow is
+# installed, otherwise pickle).
+# The file is written to a temporary file in the same directory first, which
+# then replaces the cache file, so another process (or the next run, if this
+# one is interrupted) never reads a partially written cache file.
+def write_cache_file(df: pd.DataFrame, cache_path: str) -> None:
+    fd, tmp_path = tempfile.mkstemp(prefix=basename(cache_path) + '.',
+                                    suffix='.tmp', dir=dirname(cache_path) or '.')
+    os.close(fd)
+    try:
+        if pacsv is not None:
+            # zstd makes the files ~30% smaller than the default (snappy),
+            # and they are read just as fast.
+            if pa.Codec.is_available('zstd'):
+                df.to_parquet(tmp_path, index=False, compression='zstd')
+            else:
+                df.to_parquet(tmp_path, index=False)
+        else:
+            df.to_pickle(tmp_path, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, cache_path)
+    finally:
+        if exists(tmp_path):
+            os.remove(tmp_path)
+
+# A request: find the statistics within distance [miles] of a county.
+# Requests are immutable (and hashable), so they can be used as keys to
+# look up previous results.
+@dataclass(frozen=True)
+class Request:
+    county: str
+    state: str
+    distance: float
 
 # Covid-19 Data class.
 # Will handle verifying and loading input data.
 # Will also include functions for basic calculations.
 class CovidData:
 
-    # Dictionary for storing NY times COVID19 counties data.
-    covid_dict = {}
-
-    # Dictionary for storing lon/lat of every county in US.
-    # From Healthcare.gov dataset
-    geo_dict = {}
-
     # List of first 4 columns expected in the counties data input file.
     # This will be verified with the header line from the input file.
     # The remaining column names will be considered the valid statistic types
@@ -43,8 +231,18 @@ class CovidData:
                       'county', 'type', 'world_region', 'country',
                       'decommissioned', 'estimated_population', 'notes']
 
+    # Minimum number of counties (locations) for which a BallTree is built.
+    # Since the counties are sorted by latitude, the search without a tree is
+    # as fast as a tree query for a single request. The tree only pays for
+    # importing scikit-learn (~1 s) and building it (~1 us per county) in
+    # batches of hundreds of requests over a million or more counties, not
+    # for the ~3200 US counties.
+    tree_min_counties = 1000000
+
+    # Optionally, only the statistics listed in stats are loaded (all of them
+    # if it is None).
     def __init__(self, counties_path: str, geocodes_path:str,
-                 target_date: date) -> None:
+                 target_date: date, stats: list = None) -> None:
 
         # Load counties and geocode data.
         self.counties_path = counties_path
@@ -54,14 +252,23 @@ class CovidData:
         self.target_date = target_date
 
         # Will need a list of statistics names
+        self.stats = stats
         self.stat_names = []
 
+        # Results of compute_stats, by (request, statistic), so that repeated
+        # requests are not computed again.
+        self._results = {}
+
         # Load counties and geo locations data.
-        self.load_counties_data()
-        self.load_geocodes_data()
+        counties_df = self.load_counties_data()
+        geo_df = self.load_geocodes_data()
+
+        # Store the loaded data as arrays for the distance calculations.
+        self.build_arrays(geo_df, counties_df)
 
     # Function to load and verify counties data.
-    def load_counties_data(self) -> None:
+    # Returns one row per county: state, county, fips and the statistics.
+    def load_counties_data(self) -> pd.DataFrame:
         # If input path does not exist, raise fatal error (for now).
         # Future work: If file is missing, attempt to download automatically
         # using python requests library.
@@ -71,175 +278,246 @@ class CovidData:
         # The input could be the NY times file containing all data, which
         # has limited statistic types, or the live version which has more
         # statistics.
-        # As this file could (in thoery) be quite large, will read through it line by line
+        # Validate header and obtain types of statistics
         with open(self.counties_path, 'r') as f:
-            # Read the first line (header)
-            line = f.readline()
-            linenum = 1
-
-            # Validate header and obtain types of statistics
-            self.stat_names = self.validate_header(line, self.counties_data_types)
-            # Read the rest of the file line by line.
-            while line:
-                line = f.readline()
-
-                # Load line data into dictionary based on expected
-                # and validated format.
-                line_data = line.rstrip().split(',')
-
-                # If there are not the expected number of comma-separated
-                # entries, output error and skip the line:
-                if len(line_data) != self.num_fixed_types + len(self.stat_names):
-                    print("Warning: Incomplete data for line #%d" %linenum)
-                    print("Skipping line: %s" %line)
-                    linenum += 1
-                    continue
-
-                # If a target date was selected, compute the
-                # current date as datetime object for comparison:
-                if self.target_date:
-                    year, month, day = line_data[0].split('-')
-                    current_date = date(int(year), int(month), int(day))
-                else:
-                    current_date = None
-
-                # If target date is slected, current date must be the target
-                # or we skip the line.
-                # If target date is NOT selected, we continue to process the
-                # data under the assumption that only data for the
-                # most recent date in the dataset is to be used.
-                
-                # NOTE: Each row of data contains the TOTAL of each statistic
-                # for that date, NOT the contribution of that date.
-                # Example: The number of cases on a date will always be >= the
-                # number of cases for a previous date.
-                # The dates are assumed to be in decending chronological order.
-                
-                # If there are multiple entries for a county, with no target
-                # date selected, the most recent entry (corresponds to the
-                # most recent date) will be added into the database. This should
-                # not happen if the code is properly used and a warning will be
-                # displayed.
-                if self.target_date and current_date != self.target_date:
-                    linenum += 1
-                    continue
-
-                # Assumptions of columns of these data.
-                # Use map of state names to abbreviations imported above
-                # to store the abbreviated state name internally.
-                # (This is to be consistent with geo data set).
-                county = line_data[1]
-                state = us_state_abbrev[line_data[2]]
-                fips = line_data[3]
-
-                # Add to data dict by state.
-                if not state in self.covid_dict:
-                    self.covid_dict[state] = {}
-
-
-                # If county hasn't been added yet, initialize it with
-                # the fips value.
-                if not county in self.covid_dict[state]:
-                    self.covid_dict[state][county] = {'fips': fips}
-                else:
-                    # This shouldn't happen if code is properly used
-                    # as it corresponds to a county already being added
-                    # from an earlier date. Output warning and replace.
-                    print("Warning: Data for %s/%s already loaded." %(
-                           county, state))
-                    print("Replacing with data for date: %s" %line_data[0])
-                    self.covid_dict[state][county]['fips'] = fips
-
-                # Loop over remaining statistics
-                for i, stat in enumerate(self.stat_names):
-                    # Value should be an integer.
-                    # Will treat empty string (missing data) as 0.
-                    value = line_data[i + self.num_fixed_types]
-                    if not value:
-                        value = 0
-                    else:
-                        value = int(value)
-                    # Enter value for the stat name
-                    self.covid_dict[state][county][stat] = value
-
-                # Increment line num
-                linenum += 1
+            self.stat_names = self.validate_header(next(f, ''),
+                                                   self.counties_data_types)
+
+        # If only some statistics were selected, the other columns are not
+        # parsed at all.
+        if self.stats is not None:
+            for stat in self.stats:
+                if stat not in self.stat_names:
+                    raise ValueError("Error: "
+                                     "Statistic %s not found in data inputs." %stat)
+            self.stat_names = list(self.stats)
+
+        # As this file could be quite large, let pyarrow (or pandas) parse it
+        # in one pass instead of reading it line by line in python.
+        # Only empty statistic cells are treated as missing (NaN), so county
+        # names and fips codes are kept exactly as they appear in the file.
+        # The statistics are declared as floats (integer columns can't store
+        # missing values) to skip type inference. They are converted to
+        # integers once, when the arrays are built.
+        # The state and county names are read as categories (there are only
+        # ~50 states and ~2000 county names for up to hundreds of thousands
+        # of rows), so each name is stored once with small integer codes.
+        dtypes = {'date': str, 'county': 'category', 'state': 'category', 'fips': str}
+        dtypes.update({stat: np.float64 for stat in self.stat_names})
+        df = read_csv_cached(self.counties_path, dtypes)
+
+        # If target date is slected, only keep the rows for that date.
+        # If target date is NOT selected, we continue to process the
+        # data under the assumption that only data for the
+        # most recent date in the dataset is to be used.
+
+        # NOTE: Each row of data contains the TOTAL of each statistic
+        # for that date, NOT the contribution of that date.
+        # Example: The number of cases on a date will always be >= the
+        # number of cases for a previous date.
+        # The dates are assumed to be in decending chronological order.
+        # The dates are in yyyy-mm-dd format, so compare them to the target
+        # date as strings instead of converting every row to a date.
+        if self.target_date:
+            df = df[df['date'] == self.target_date.isoformat()]
+
+        # Use map of state names to abbreviations imported above
+        # to store the abbreviated state name internally.
+        # (This is to be consistent with geo data set).
+        # Only the categories need to be renamed, not every row.
+        df['state'] = df['state'].cat.rename_categories(us_state_abbrev)
+
+        # If there are multiple entries for a county, with no target
+        # date selected, the most recent entry (corresponds to the
+        # most recent date) will be added into the database. This should
+        # not happen if the code is properly used and a warning will be
+        # displayed.
+        duplicates = df.duplicated(['state', 'county'])
+        for county, state, day in zip(df['county'][duplicates],
+                                      df['state'][duplicates],
+                                      df['date'][duplicates]):
+            print("Warning: Data for %s/%s already loaded." %(county, state))
+            print("Replacing with data for date: %s" %day)
+        df = df.drop_duplicates(['state', 'county'], keep='last')
+        return df[['state', 'county', 'fips'] + self.stat_names]
 
     # Function to load and verify geocodes (lon/lat) data for each county.
-    def load_geocodes_data(self) -> None:
+    # Returns one row per county: state, county, lat, lon and population.
+    def load_geocodes_data(self) -> pd.DataFrame:
         # If path does not exist, raise fatal error (for now).
         # Future work: If file is missing, attempt to download automatically
         # using python requests library.
-        if not exists(self.counties_path):
-            raise RuntimeError("Error: Geocodes data file %s not found." %self.counties_path)
+        if not exists(self.geocodes_path):
+            raise RuntimeError("Error: Geocodes data file %s not found." %self.geocodes_path)
 
-        # Read through it line by line
         # Note: Will make some assumptions about the format of this csv file
-        # In terms of the column numbers of the data we actually want.
+        # In terms of the columns of the data we actually want.
         # Specifically: state, county, lat/lon, and estimated population
         # Given the nature of what this file repsents, I am assuming the
         # structure and content of this file should not change frequently.
-        with open(self.geocodes_path, 'r') as f:
-            # Read the first line (header)
-            line = f.readline()
-            linenum = 1
-
-            # Read the rest of the file line by line.
-            while line:
-                line = f.readline()
-
-                # Load line data into dictionary based on expected
-                # and validated format.
-                line_data = line.rstrip().split(',')
-
-                # If there are not at least the expected number of colums,
-                # Output a warning and skip the line.
-                # Note: with this file, sometimes the data in the note columns
-                # include commas, which result in more elements when split.
-                # However, this should not affect our assumptions below.
-                if len(line_data) < len(self.geo_data_types):
-                    print("Warning: Incomplete data for line #%d" %linenum)
-                    print("Skipping line: %s" %line)
-                    linenum += 1
-                    continue
-
-                # Assumptions of where data is, make sure to store population
-                # as an int and lat/lon as float.
-                state = line_data[2]
-                county = line_data[5]
-                lat = float(line_data[3])
-                lon = float(line_data[4])
-                population = int(line_data[10])
-
-                # The data in this file is actually for specific cities, so
-                # there are often multiple entries per county.
-                # However, each city has slightly different lat/lon cordinates
-                # To choose which lat/lon to consider for the county, I will
-                # keep track of the city with the highest estimated population.
-
-                # Add to data dict by state.
-                if not state in self.geo_dict:
-                    self.geo_dict[state] = {}
-
-
-                # If county hasn't been added yet, initalize it with above data.
-                if not county in self.geo_dict[state]:
-                    self.geo_dict[state][county] = {'lat': lat, 'lon': lon,
-                                                    'population': population,
-                                                    'largest_city': population}
-                else:
-                    # Otherwise:
-                    # 1) Add current city population to total
-                    # 2) If current population is larger than previous city max,
-                    # update lat/lon and set a new largest_city population.
-                    self.geo_dict[state][county]['population'] += population
-                    if population > self.geo_dict[state][county]['largest_city']:
-                        self.geo_dict[state][county]['lat'] = lat
-                        self.geo_dict[state][county]['lon'] = lon
-                        self.geo_dict[state][county]['largest_city'] = population
-                        
-                linenum += 1
-                
+        # Only these columns are parsed (the notes column can contain commas,
+        # which is fine as it is quoted).
+        # The coordinates are parsed in double precision so they are
+        # reported exactly as written in the file (see build_arrays).
+        df = read_csv_cached(self.geocodes_path,
+                             {'state': str, 'county': str,
+                              'latitude': np.float64, 'longitude': np.float64,
+                              'estimated_population': np.int64})
+
+        # The data in this file is actually for specific cities, so
+        # there are often multiple entries per county.
+        # However, each city has slightly different lat/lon cordinates
+        # To choose which lat/lon to consider for the county, I will
+        # use the city with the highest estimated population
+        # (the first one listed in case of a tie).
+        largest = df.sort_values('estimated_population', ascending=False,
+                                 kind='stable')
+        largest = largest.drop_duplicates(['state', 'county'])
+
+        # The population of the county is the total of all its cities.
+        totals = df.groupby(['state', 'county'], sort=False)['estimated_population'].sum()
+
+        # Keep the counties in the order they first appear in the file.
+        largest = largest.set_index(['state', 'county']).reindex(totals.index)
+        return pd.DataFrame({'lat': largest['latitude'],
+                             'lon': largest['longitude'],
+                             'population': totals}).reset_index()
+
+    # Function to store the geo and counties data as parallel numpy arrays
+    # (one entry per county in the geo database), owned by this instance.
+    # This lets compute_stats find every county within range of a request
+    # with a few vectorized operations instead of a python loop.
+    def build_arrays(self, geo_df: pd.DataFrame,
+                     counties_df: pd.DataFrame) -> None:
+        # Count entries in the geo database do not have names for
+        # the county. I will skip these for now.
+        geo_df = geo_df[geo_df['county'] != '']
+
+        # It's okay if a county exists in the geo database but not
+        # in the counties database. Keep track of which ones have data,
+        # and use 0 for their statistics.
+        df = geo_df.merge(counties_df, on=['state', 'county'], how='left',
+                          sort=False)
+        # The counties are stored in order of latitude, so the ones within a
+        # range of latitudes are a contiguous slice of the arrays that can be
+        # found with a binary search (see find_in_range).
+        df = df.sort_values('lat', kind='stable', ignore_index=True)
+        self._has_data = df['fips'].notna().to_numpy()
+        # The fips and (county, state) names of every county are stored as
+        # arrays of python objects, so the lists in the results can be built
+        # with a single take (see make_result).
+        self._fips = df['fips'].fillna('').to_numpy(object)
+        # Values should be integers.
+        # Will treat empty string (missing data) as 0.
+        # All statistics are converted together as one (statistics x
+        # counties) block, and each row of it is the array of a statistic.
+        values = df[self.stat_names].to_numpy(np.float64, na_value=0.0)
+        values = np.ascontiguousarray(values.T, dtype=np.int32)
+        self._stats = dict(zip(self.stat_names, values))
+
+        self._states = df['state'].tolist()
+        self._counties = df['county'].tolist()
+        self._state_names = frozenset(self._states)
+        self._names = np.empty(len(df), dtype=object)
+        self._names[:] = list(zip(self._counties, self._states))
+        # The coordinates are kept in double precision to report them in
+        # the results (see make_result).
+        self._lat = df['lat'].to_numpy(np.float64)
+        self._lon = df['lon'].to_numpy(np.float64)
+        # Likewise, county populations fit in 32 bit integers (sums of them
+        # are computed with 64 bit integers).
+        self._pop = df['population'].to_numpy(np.int32)
+
+        # Look up table from (state, county) to the index of the county in
+        # the arrays, used to find the origin of each request.
+        self._index = {key: i for i, key in
+                       enumerate(zip(self._states, self._counties))}
+
+        # The distance calculations work in radians, and cos(lat) of every
+        # county is needed by every one of them, so compute these once here.
+        # Single precision is plenty for the distance calculations (float32
+        # is accurate to well under a meter at these latitudes/longitudes),
+        # and halves the memory read by every one of them.
+        self._lat_rad = np.radians(self._lat).astype(np.float32)
+        self._lon_rad = np.radians(self._lon).astype(np.float32)
+        self._cos_lat = np.cos(self._lat_rad)
+
+        self._tree = None
+        if len(self._lat) >= self.tree_min_counties:
+            self.build_tree()
+
+    # Function to build a BallTree over the county coordinates (in radians, as
+    # required by the haversine metric) for radius queries, if scikit-learn
+    # is installed.
+    def build_tree(self) -> None:
+        BallTree = import_ball_tree()
+        if BallTree is None:
+            return
+        # Most requests only reach a few counties, so smaller leaves than the
+        # default (40) make the queries faster, for a slightly slower build
+        # (~0.2 ms for all the counties).
+        self._tree = BallTree(np.c_[self._lat_rad, self._lon_rad],
+                              metric='haversine', leaf_size=16)
+
+    # Function to find every county within distance [miles] of the origin
+    # (lat/lon in radians).
+    # Returns the array indices of these counties (in ascending order)
+    # and their distances from the origin in miles.
+    def find_in_range(self, origin: tuple, distance: float) -> tuple:
+        if self._tree is not None:
+            return self.query_tree([origin], distance)[0]
+
+        # With numba, the whole search is a single compiled loop.
+        find_in_range_numba = import_find_in_range_numba()
+        if find_in_range_numba is not None:
+            return find_in_range_numba(origin[0], origin[1], self._lat_rad,
+                                       self._lon_rad, self._cos_lat, distance)
+
+        # Otherwise, only the counties within the angular distance (in
+        # radians) of the origin in latitude can be in range. As the arrays
+        # are sorted by latitude, these are found with a binary search.
+        # A small margin is added so float32 rounding can't drop a county
+        # that is right at the edge of the range.
+        margin = 1e-5
+        angle = distance/EARTH_RADIUS_MI
+        lo, hi = np.searchsorted(self._lat_rad, (origin[0] - angle - margin,
+                                                 origin[0] + angle + margin))
+
+        # Of these, drop the counties outside the range of longitudes around
+        # the origin that contains the whole range, with a few cheap
+        # comparisons. The max longitude difference grows with latitude, and
+        # can't be limited if the range includes a pole.
+        idx = np.arange(lo, hi)
+        if math.sin(angle) < math.cos(origin[0]) and angle < math.pi/2:
+            max_dlon = math.asin(math.sin(angle)/math.cos(origin[0])) + margin
+            # Longitudes wrap around at +/-180 degrees.
+            dlon = np.abs(self._lon_rad[lo:hi] - origin[1])
+            idx = idx[np.minimum(dlon, 2*math.pi - dlon) <= max_dlon]
+
+        # Then get distance between the origin and the remaining counties.
+        # Only compute the first part of the haversine formula to find the
+        # counties in range, and the rest only for these.
+        lat, lon, cos_lat = self._lat_rad[idx], self._lon_rad[idx], self._cos_lat[idx]
+        a = haversine_term(origin, lat, lon, cos_lat)
+        in_range = a <= miles_to_haversine_term(distance)
+        return idx[in_range], haversine_term_to_miles(a[in_range])
+
+    # Function to find every county within range of each origin (lat/lon in
+    # radians) with the BallTree, for the distance [miles] of each origin
+    # (or the same distance for all of them).
+    # Returns the array indices of the counties (in ascending order) and
+    # their distances in miles, for each origin.
+    def query_tree(self, origins: list, distances) -> list:
+        # The tree works on a unit sphere, so convert miles to radians.
+        all_idx, all_dist = self._tree.query_radius(origins,
+                                                    r=np.asarray(distances)/EARTH_RADIUS_MI,
+                                                    return_distance=True)
+        found = []
+        for idx, dist in zip(all_idx, all_dist):
+            order = np.argsort(idx)
+            found.append((idx[order], dist[order]*EARTH_RADIUS_MI))
+        return found
+
     # Validate counties data header info
     def validate_header(self, header: str, data_names: list) ->None:
 
@@ -258,19 +536,152 @@ class CovidData:
         # This will serve as names of valid statistics for this input file.
         return data_types[self.num_fixed_types:]
 
-    # Function to compute number of statistics within user selected range
-    def compute_stats(self, request: dict, stat: str) -> dict:
-        # Items of the request
-        state = request['state']
-        county = request['county']
-        distance = request['distance']
+    # Function to find the index of the county of a request (its origin).
+    def find_origin(self, request: Request) -> int:
+        state = request.state
+        county = request.county
+
+        # A single look up finds valid requests. If it fails, check whether
+        # the state or only the county is invalid, for the error message.
+        origin_index = self._index.get((state, county))
+        if origin_index is None:
+            # Verify state abbreviation is valid.
+            if not state in self._state_names:
+                raise ValueError("State %s not found in location data. " %state)
+            # Otherwise the county is not found in the state.
+            raise ValueError("County %s not found in state %s" %(county, state))
+        return origin_index
 
+    # Function to compute number of statistics within user selected range
+    def compute_stats(self, request: Request, stat: str) -> dict:
         # If stat is not found in the previously computed list of
         # raise error.
         if stat not in self.stat_names:
             raise ValueError("Error: "
                              "Statistic %s not found in data inputs." %stat)
-        print("Finding number of %s within %.2f [mi] for %s %s" %(stat, distance, county, state))
+
+        # Verify the county/state of the request before doing anything else.
+        origin_index = self.find_origin(request)
+        print("Finding number of %s within %.2f [mi] for %s %s" %(
+              stat, request.distance, request.county, request.state))
+
+        # Requests that were computed before are not computed again.
+        if (request, stat) not in self._results:
+            # Get every county within the inputted range (and distance to it)
+            # in miles. If the county is in the NY times counties database
+            # then add the stats info.
+
+            # NOTE: It's okay if a county exists in the geo database but not
+            # in the counties database. We'll just skip it.
+            # However, if the county is not in the geo database, and lat/lon
+            # cannot be determined, this is an error (as above).
+            origin = (self._lat_rad[origin_index], self._lon_rad[origin_index])
+            hits, dist = self.find_in_range(origin, request.distance)
+            self.store_result(request, stat, origin_index, hits, dist)
+        return self.stored_result(request, stat)
+
+    # Function to compute the statistics for a list of requests at once.
+    # Returns the same results as calling compute_stats for each request,
+    # but the distances from all origins to all counties are computed in
+    # one (requests x counties) numpy operation (or one BallTree query),
+    # instead of one pass over the county arrays per request.
+    def compute_stats_batch(self, requests: list, stat: str) -> list:
+        if stat not in self.stat_names:
+            raise ValueError("Error: "
+                             "Statistic %s not found in data inputs." %stat)
+        if not requests:
+            return []
+        # Verify the county/state of every request before doing anything else.
+        origins = [self.find_origin(request) for request in requests]
+        for request in requests:
+            print("Finding number of %s within %.2f [mi] for %s %s" %(
+                  stat, request.distance, request.county, request.state))
+
+        # Only compute the requests that were not computed before (once each).
+        todo = {}
+        for request, origin_index in zip(requests, origins):
+            if (request, stat) not in self._results:
+                todo[request] = origin_index
+        if todo:
+            self.compute_batch(list(todo), np.array(list(todo.values())), stat)
+        return [self.stored_result(request, stat) for request in requests]
+
+    # Function to compute and store the results of a list of requests, given
+    # the indices of their origins, for compute_stats_batch.
+    def compute_batch(self, requests: list, origins: np.ndarray,
+                      stat: str) -> None:
+        distances = np.array([request.distance for request in requests])
+
+        if self._tree is not None:
+            points = np.c_[self._lat_rad[origins], self._lon_rad[origins]]
+            found = self.query_tree(points, distances)
+            for request, origin_index, (hits, dist) in zip(requests, origins, found):
+                self.store_result(request, stat, origin_index, hits, dist)
+            return
+
+        # First part of the haversine formula from every origin (rows) to
+        # every county (columns), which is enough to find the counties in
+        # range. The distances are only computed for these (below).
+        a = haversine_term((self._lat_rad[origins][:, None],
+                            self._lon_rad[origins][:, None]),
+                           self._lat_rad, self._lon_rad, self._cos_lat)
+        in_range = (a <= miles_to_haversine_term(distances)[:, None]) & self._has_data
+
+        # Sum the statistic and population of the counties in range of
+        # every request with a single matrix product (counties x 2 block of
+        # the two arrays). This is done in double precision, which numpy
+        # computes with BLAS (~3x faster than integer products), and is
+        # exact as long as the totals are below 2**53.
+        values = np.column_stack((self._stats[stat], self._pop)).astype(np.float64)
+        totals = in_range.astype(np.float64) @ values
+        stat_totals, populations = totals[:, 0], totals[:, 1]
+
+        for i, request in enumerate(requests):
+            hits = np.flatnonzero(in_range[i])
+            self._results[(request, stat)] = self.make_result(
+                request, stat, origins[i], hits,
+                haversine_term_to_miles(a[i, hits]),
+                int(stat_totals[i]), int(populations[i]))
+
+    # Function to compute and store the result of a request, given the
+    # indices of (and distances to) the counties found within range.
+    # Only the counties with data in the counties database are counted.
+    def store_result(self, request: Request, stat: str, origin_index: int,
+                     hits: np.ndarray, dist: np.ndarray) -> None:
+        has_data = self._has_data[hits]
+        hits, dist = hits[has_data], dist[has_data]
+        stat_total = int(self._stats[stat][hits].sum(dtype=np.int64))
+        population = int(self._pop[hits].sum(dtype=np.int64))
+        self._results[(request, stat)] = self.make_result(
+            request, stat, origin_index, hits, dist, stat_total, population)
+
+    # Function to print the summary of the stored result of a request, and
+    # return a copy of it (so the caller can't modify the stored lists).
+    def stored_result(self, request: Request, stat: str) -> dict:
+        result = self._results[(request, stat)]
+        self.print_result(result, request.distance)
+        return dict(result, fips=list(result['fips']),
+                    counties=list(result['counties']))
+
+    # Function to create the results dictionary of a request, given the
+    # indices of (and distances to) the counties found within range.
+    def make_result(self, request: Request, stat: str, origin_index: int,
+                    hits: np.ndarray, dist: np.ndarray, stat_total: int,
+                    population: int) -> dict:
+        state = request.state
+        county = request.county
+
+        # Details for every county found are only logged in debug mode,
+        # as formatting and printing them is slower than the search itself.
+        if logger.isEnabledFor(logging.DEBUG):
+            running_total = 0
+            for i, d in zip(hits, dist):
+                value = int(self._stats[stat][i])
+                logger.debug("Dist between %s/%s in and %s/%s is %.2f [miles]",
+                             county, state, self._counties[i], self._states[i], d)
+                logger.debug("Adding %d %s to %d from %s/%s", value, stat,
+                             running_total, self._counties[i], self._states[i])
+                running_total += value
 
         # Results dictionary to return storing relevant information.
         # 1) statistic total
@@ -281,54 +692,17 @@ class CovidData:
         # 5) lat/lon for target county
         # 6) State/name of target county
         result = {'state': state, 'county': county,
-                  'fips': list(), 'counties': list(),
-                  'stat': stat, 'population': 0,
-                  'stat_total': 0}
+                  'fips': self._fips[hits].tolist(),
+                  'counties': self._names[hits].tolist(),
+                  'stat': stat, 'population': population,
+                  'stat_total': stat_total,
+                  'cords': (float(self._lat[origin_index]),
+                            float(self._lon[origin_index]))}
 
-        # Verify state abbreviation is valid.
-        if not state in self.geo_dict:
-            raise ValueError("State %s not found in location data. " %state)
-
-        # Verify that county is found in the state.
-        if not county in self.geo_dict[state]:
-            raise ValueError("County %s not found in state %s" %(county, state))
-
-        # Store origin lat/lon coordinates:
-        origin = (self.geo_dict[state][county]['lat'],
-                  self.geo_dict[state][county]['lon'])
-        result['cords'] = origin
-        
-        # Loop over each county in each state and compute haversine distance.
-        for new_state in self.geo_dict:
-            for new_county in self.geo_dict[new_state]:
-
-                # Count entries in the geo database do not have names for
-                # the county. I will skip these for now.
-                if not new_county:
-                    continue
-                
-                point = (self.geo_dict[new_state][new_county]['lat'],
-                         self.geo_dict[new_state][new_county]['lon'])
-
-                # Get distance between counties in miles
-                dist = haversine(origin, point)
-
-                # If distance is <= the inputted range
-                # AND the county is in the NY times counties database
-                # then add the stats info.
-                
-                # NOTE: It's okay if a county exists in the geo database but not
-                # in the counties database. We'll just skip it.
-                # However, if the county is not in the geo database, and lat/lon
-                # cannot be determined, this is an error (as above).
-                if dist <= distance and new_county in self.covid_dict[new_state]:
-                    print("Dist between %s/%s in and %s/%s is %.2f [miles]" %(county, state, new_county, new_state, dist))
-                    print("Adding %d cases to %d from %s/%s" %(self.covid_dict[new_state][new_county][stat], result['stat_total'], new_county, new_state))
-                    result['stat_total'] += self.covid_dict[new_state][new_county][stat]
-                    result['population'] += self.geo_dict[new_state][new_county]['population']
-                    result['counties'].append((new_county, new_state))
-                    result['fips'].append(self.covid_dict[new_state][new_county]['fips'])
+        return result
 
+    # Function to print the summary of the result of a request.
+    def print_result(self, result: dict, distance: float) -> None:
         print("In total there are %d %s within %.2f [miles] of %s/%s, a region with %d people." %(
-              result['stat_total'], stat, distance, county, state, result['population']))
-        return result
+              result['stat_total'], result['stat'], distance, result['county'],
+              result['state'], result['population']))
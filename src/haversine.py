@@ -13,17 +13,75 @@
 
 import math
 
+import numpy as np
+
 def haversine(origin: tuple, destination: tuple) -> float:
     lat1, lon1 = origin
     lat2, lon2 = destination
     radius = 6371 # km
 
-    dlat = math.radians(lat2-lat1)
-    dlon = math.radians(lon2-lon1)
-    a = math.sin(dlat/2) * math.sin(dlat/2) + math.cos(math.radians(lat1)) \
-        * math.cos(math.radians(lat2)) * math.sin(dlon/2) * math.sin(dlon/2)
+    # Compute each sine only once (instead of squaring by calling it twice).
+    sin_dlat = math.sin(math.radians(lat2-lat1)/2)
+    sin_dlon = math.sin(math.radians(lon2-lon1)/2)
+    a = sin_dlat*sin_dlat + math.cos(math.radians(lat1)) \
+        * math.cos(math.radians(lat2)) * sin_dlon*sin_dlon
     c = 2 * math.atan2(math.sqrt(a), math.sqrt(1-a))
     d = radius * c
 
     # Currently d is in km. We want it in miles
     return d/1.60934 # 1.60934 [km/mi]
+
+# Optional: cHaversine implements the same formula in C. If it is installed,
+# use it instead of the python version above.
+try:
+    from cHaversine import haversine as c_haversine
+
+    def haversine(origin: tuple, destination: tuple) -> float:
+        # cHaversine returns the distance in meters. We want it in miles.
+        return c_haversine(origin, destination)/1609.34 # 1609.34 [m/mi]
+except ImportError:
+    pass
+
+# Vectorized version of the formula above, computing the distance from one
+# origin to every destination in the lat/lon arrays in a single numpy pass.
+# Here the origin and the lat/lon arrays are in radians, so the destinations
+# can be converted once ahead of time. For the same reason, cos_lat is
+# cos(lat) of the destinations, which does not depend on the origin.
+# The origin can also be a pair of (n, 1) arrays, in which case the result
+# is the (n, len(lat)) matrix of distances from every origin.
+def haversine_vector(origin: tuple, lat: np.ndarray, lon: np.ndarray,
+                     cos_lat: np.ndarray) -> np.ndarray:
+    return haversine_term_to_miles(haversine_term(origin, lat, lon, cos_lat))
+
+# The first half of the formula: the "a" term (the squared sine of half the
+# angle between the origin and each destination), with the same arguments
+# as haversine_vector.
+# The distance only grows with "a", so to find the destinations within a
+# distance, "a" can be compared to the value of "a" at that distance
+# (miles_to_haversine_term). Then the rest of the formula (sqrt and arcsin)
+# only needs to be computed for the destinations that are within range.
+def haversine_term(origin: tuple, lat: np.ndarray, lon: np.ndarray,
+                   cos_lat: np.ndarray) -> np.ndarray:
+    lat1, lon1 = origin
+
+    dlat = lat - lat1
+    dlon = lon - lon1
+    return np.sin(dlat*0.5)**2 + np.cos(lat1) * cos_lat * np.sin(dlon*0.5)**2
+
+# The second half of the formula: distance in miles from the "a" term.
+def haversine_term_to_miles(a: np.ndarray) -> np.ndarray:
+    radius = 6371 # km
+    c = 2 * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+    d = radius * c
+
+    # Currently d is in km. We want it in miles
+    return d/1.60934 # 1.60934 [km/mi]
+
+# The inverse of haversine_term_to_miles: the "a" term at a distance in miles
+# (which can also be an array of distances).
+# Distances beyond half the earth's circumference give 1 (everything is in
+# range), and negative distances give -1 (nothing is, not even the origin).
+def miles_to_haversine_term(distance: float) -> float:
+    radius = 6371 # km
+    c = np.clip(distance*1.60934/radius, 0.0, np.pi) # 1.60934 [km/mi]
+    return np.where(np.asarray(distance) < 0, -1.0, np.sin(c*0.5)**2)
@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+
+####################################################################
+#                 Covid-19 Data Visualization Tool                 #
+#                     Author: Jonathan Kemal                       #
+#   Numba compiled version of the vectorized haversine formula.    #
+#      Only used if numba is installed (see data_functions.py).    #
+####################################################################
+
+import math
+
+import numpy as np
+from numba import njit
+
+# Function to find every destination within distance [miles] of the origin,
+# with the same formula as haversine_vector in haversine.py, compiled to a
+# single loop over the destinations (no temporary arrays are created for the
+# intermediate steps).
+# The origin and lat/lon arrays are in radians, and cos_lat is cos(lat) of
+# the destinations, all computed once ahead of time.
+# Returns the indices of the destinations in range (in ascending order) and
+# their distances from the origin in miles.
+# The destinations must be sorted by latitude, so the ones within the
+# distance in latitude alone are found with a binary search, and the others
+# are skipped. The remaining ones are compared using the haversine term, so
+# the distance (sqrt and arcsin) is only computed for the ones in range.
+# The loop is not parallel, as the indices are collected in order.
+# fastmath relaxes IEEE rules (no NaN/inf checks, reassociation), which lets
+# the compiler simplify the arithmetic; the branch keeps it from vectorizing.
+# The constants are cast to the dtype of the coordinates, so float32 inputs
+# stay in single precision inside the loop.
+@njit(fastmath=True, cache=True)
+def find_in_range_numba(origin_lat: float, origin_lon: float, lat: np.ndarray,
+                        lon: np.ndarray, cos_lat: np.ndarray,
+                        distance: float) -> tuple:
+    dtype = lat.dtype
+    diameter = dtype.type(2*6371.0/1.60934) # [mi], 6371 km and 1.60934 [km/mi]
+    half = dtype.type(0.5)
+    cos_lat1 = dtype.type(math.cos(origin_lat))
+    one = dtype.type(1.0)
+
+    # Angle (in radians) and haversine term at the distance. A small margin
+    # is added to the latitude range so float32 rounding can't skip a
+    # destination that is right at the edge of the range.
+    # Nothing is in range of a negative distance (not even the origin).
+    if distance < 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=dtype)
+    angle = min(2*distance/diameter, math.pi)
+    max_a = math.sin(angle*0.5)**2
+    lo = np.searchsorted(lat, origin_lat - angle - 1e-5)
+    hi = np.searchsorted(lat, origin_lat + angle + 1e-5)
+
+    idx = np.empty(hi - lo, dtype=np.int64)
+    dist = np.empty(hi - lo, dtype=dtype)
+    count = 0
+    for i in range(lo, hi):
+        sin_dlat = np.sin((lat[i] - origin_lat)*half)
+        sin_dlon = np.sin((lon[i] - origin_lon)*half)
+        a = sin_dlat*sin_dlat + cos_lat1*cos_lat[i]*sin_dlon*sin_dlon
+        if a <= max_a:
+            idx[count] = i
+            dist[count] = diameter*np.arcsin(np.sqrt(min(a, one)))
+            count += 1
+    return idx[:count], dist[:count]
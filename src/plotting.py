@@ -10,6 +10,7 @@
 from datetime import date
 from os.path import join
 
+import numpy as np
 import plotly.figure_factory as ff
 
 # This funciton will plot all requests atop one US map.
@@ -20,94 +21,62 @@ import plotly.figure_factory as ff
 def plot_results(results: list, stat: str,
                  target_date: date, save_path: str) -> None:
 
-    # Will use 5 bins and this color scheme.
-    colorscale = ["#030512", "#323268", "#3e6ab0",
-                  "#60a7c7", "#85c5d3", "#b7e0e4"]
-
     # What will ultimatedly be plotted: fips for each county in each range,
-    # and the values (e.g. total cases in region).
-    fips = []
-    values = []
+    # and the values (e.g. total cases in region) of the range it's in.
+    # The values are computed once per request, then repeated for each
+    # county in its range.
+    fips = [f for result in results for f in result['fips']]
+    num_fips = [len(result['fips']) for result in results]
+    stat_totals = np.array([result['stat_total'] for result in results],
+                           dtype=np.int64)
+    populations = np.array([result['population'] for result in results],
+                           dtype=np.float64)
 
-    # Create/slow the raw total plot.
-    
-    # Keep track of biggest value of stat to use for bin creation
-    biggest_stat_value = 0
-    for result in results:
-        biggest_stat_value = max(biggest_stat_value, result['stat_total'])
-        fips.extend(result['fips'])
-        values.extend([result['stat_total']]*len(result['fips']))
-    
-    # Calculate bin size based on largest value in set
-    bin_size = biggest_stat_value//5
-    total_bins = [0]*5
-    for i in range(5):
-        total_bins[i] = (i + 1)*bin_size
+    # All population densities will be per 100,000 people
+    stat_densities = 100000.0*stat_totals/populations
 
     # If we specified a target date, output it on the title!
     if target_date:
-        title = 'Total number of %s within specified distance of counties on %s' %(stat, target_date)
+        when = 'on %s' %target_date
     else:
-        title = 'Total number of %s within specified distance of counties for latest date.' %stat
-        
-    fig = ff.create_choropleth(
-    fips=fips, values=values,
-    binning_endpoints=total_bins, colorscale=colorscale,
-    county_outline={'color': 'rgb(255,255,255)', 'width': 1.0}, round_legend_values=True,
-    legend_title='Total number of %s' %stat,
-    title=title)
-    fig.layout.template = None
+        when = 'for latest date.'
 
-    # If save path selected, save file. Otherwise output to screen.
-    if save_path:
-        full_save_path = join(save_path, '%s_totals.png' %stat)
-        print("Saving total stat figure to: %s" %full_save_path)
-        fig.write_image(full_save_path)
-    else:
-        fig.show()
+    # Create/show the raw total plot.
+    title = 'Total number of %s within specified distance of counties %s' %(stat, when)
+    _render(fips, np.repeat(stat_totals, num_fips), stat, title,
+            save_path, '%s_totals.png' %stat)
 
-    # ===========
-    # Create and show the densities plot.
-    fips = []
-    values = []
+    # Create/show the densities plot.
+    title = 'Number of %s per 100k people within specified distance of counties %s' %(stat, when)
+    _render(fips, np.repeat(stat_densities, num_fips), stat, title,
+            save_path, '%s_density.png' %stat)
 
-    # Create/slow the raw total plot.
-    
-    # Keep track of biggest value of stat density
-    # meaning devided by population
-    # All population densities will be per 100,000 people
-    biggest_stat_density = 0.0
-    for result in results:
-        biggest_stat_density = max(biggest_stat_density, 100000.0*float(result['stat_total']/result['population']))
-        fips.extend(result['fips'])
-        values.extend([100000.0*float(result['stat_total']/result['population'])]*len(result['fips']))
+# Create one choropleth figure of the values for each fips, and save it
+# to save_path/filename if a save path is selected (otherwise show it).
+def _render(fips: list, values: np.ndarray, stat: str, title: str,
+            save_path: str, filename: str) -> None:
 
+    # Will use 6 bins and this color scheme.
+    colorscale = ["#030512", "#323268", "#3e6ab0",
+                  "#60a7c7", "#85c5d3", "#b7e0e4"]
 
-    # Calculate bin size based on largest value in set
-    bin_size = biggest_stat_density//5
-    total_bins = [0]*5
-    for i in range(5):
-        total_bins[i] = (i + 1)*bin_size
+    # Split the range up to the biggest value into 6 bins of equal size,
+    # one for each color (values <= each endpoint go in its bin).
+    biggest_value = values.max() if len(values) else 0.0
+    bins = np.linspace(0.0, biggest_value, len(colorscale) + 1)[1:-1]
 
-    # If we specified a target date, output it on the title!
-    if target_date:
-        title = 'Number of %s per 100k people within specified distance of counties on %s' %(stat, target_date)
-    else:
-        title = 'Number of %s per 100k people within specified distance of counties for latest date.' %stat
-        
     fig = ff.create_choropleth(
-    fips=fips, values=values,
-    binning_endpoints=total_bins, colorscale=colorscale,
+    fips=fips, values=values.tolist(),
+    binning_endpoints=bins.tolist(), colorscale=colorscale,
     county_outline={'color': 'rgb(255,255,255)', 'width': 1.0}, round_legend_values=True,
     legend_title='Total number of %s' %stat,
     title=title)
     fig.layout.template = None
+
     # If save path selected, save file. Otherwise output to screen.
     if save_path:
-        full_save_path = join(save_path, '%s_density.png' %stat)
-        print("Saving desnity stat figure to: %s" %full_save_path)
+        full_save_path = join(save_path, filename)
+        print("Saving figure to: %s" %full_save_path)
         fig.write_image(full_save_path)
     else:
         fig.show()
-
-    
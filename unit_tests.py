@@ -8,49 +8,226 @@
 #  Some simple unit tests for the core functions of the program.   #
 ####################################################################
 
+import copy
+import glob
+import os
+import pickle
+import tempfile
 import unittest
 from os.path import join
+from threading import Lock
+from unittest import mock
 
-from src.data_functions import CovidData
+import numpy as np
+
+from src import data_functions
+from src.data_functions import CovidData, Request
+from src.haversine import haversine, haversine_vector
+
+# Copy of a data object without its stored results, so that requests are
+# computed again.
+def _without_results(data: CovidData) -> CovidData:
+    data = copy.copy(data)
+    data._results = {}
+    return data
+
+# Use locations for files
+covid_data_path = join('input', 'us-counties-live.csv')
+geo_path = join('input', 'geocodes.csv')
+
+# Create and load the data object for tests, the first time it is needed.
+# Every test class shares the same object. The lock makes sure it is only
+# loaded once, even if test classes are set up in parallel threads.
+_data = None
+_data_lock = Lock()
+
+def _shared_data() -> CovidData:
+    global _data
+    with _data_lock:
+        if _data is None:
+            _data = CovidData(covid_data_path, geo_path, None)
+    return _data
 
 class TestInputsAndRequests(unittest.TestCase):
-    # Use locations for files
-    covid_data_path = join('input', 'us-counties-live.csv')
-    geo_path = join('input', 'geocodes.csv')
 
-    # Create and load data object for tests.
-    data = CovidData(covid_data_path, geo_path, None)
+    @classmethod
+    def setUpClass(cls):
+        cls.data = _shared_data()
 
     # Test a made up county.
     def test_madeup_county(self):
         state = "CA"
         county = "Notreal"
-        request = {'county': county, 'state': state, 'distance': 100.0}
-        try:
+        request = Request(county, state, 100.0)
+        with self.assertRaises(ValueError):
             self.data.compute_stats(request, "cases")
-        except Exception:
-            self.assertRaises(ValueError)
 
     # Test a madeup state.
     def test_madeup_state(self):
         state = "CAJON"
         county = "Notreal"
-        request = {'county': county, 'state': state, 'distance': 100.0}
-        try:
+        request = Request(county, state, 100.0)
+        with self.assertRaises(ValueError):
             self.data.compute_stats(request, "cases")
-        except Exception:
-            self.assertRaises(ValueError)
 
     # Test the result for Alameda county within 30 miles.
     # Should return 4 counties
     # Should return population of 3873655
+    # Should return the coordinates as written in the geocodes file
     def test_alameda(self):
         state = "CA"
         county = "Alameda"
-        request = {'county': county, 'state': state, 'distance': 30.0}
+        request = Request(county, state, 30.0)
         result = self.data.compute_stats(request, "cases")
         self.assertEqual(len(result['counties']), 4)
         self.assertEqual(result['population'], 3873655)
+        self.assertEqual(result['cords'], (37.59, -122.06))
+
+    # Test that computing several requests at once gives the same results
+    # as computing them one at a time.
+    def test_batch(self):
+        requests = [Request("Alameda", "CA", 30.0),
+                    Request("Los Angeles", "CA", 50.0),
+                    Request("Suffolk", "NY", 100.0)]
+        results = _without_results(self.data).compute_stats_batch(requests, "cases")
+        data = _without_results(self.data)
+        for request, result in zip(requests, results):
+            self.assertEqual(result, data.compute_stats(request, "cases"))
+
+    # Test that repeating a request gives the same result, even if the
+    # previous result was modified.
+    def test_repeated(self):
+        request = Request("Alameda", "CA", 30.0)
+        result = self.data.compute_stats(request, "cases")
+        result['counties'].clear()
+        result = self.data.compute_stats(request, "cases")
+        self.assertEqual(len(result['counties']), 4)
+
+    # Test that requests can be pickled (e.g. to send them to other
+    # processes), also as keys of the stored results of the data object.
+    def test_pickle(self):
+        request = Request("Alameda", "CA", 30.0)
+        self.assertEqual(pickle.loads(pickle.dumps(request)), request)
+        self.data.compute_stats(request, "cases")
+        data = pickle.loads(pickle.dumps(self.data))
+        self.assertEqual(data.compute_stats(request, "cases"),
+                         self.data.compute_stats(request, "cases"))
+
+# Tests of the search for counties in range with a BallTree, and without
+# one with numba and with numpy only.
+class TestSearch(unittest.TestCase):
+    # Counties at the western edge of the data (the range of longitudes
+    # wraps around +/-180 degrees), in the middle of the pacific, and the
+    # usual one, for a range of distances.
+    requests = [Request(county, state, distance)
+                for county, state in [("Aleutians West Census Area", "AK"),
+                                      ("Honolulu", "HI"), ("Alameda", "CA")]
+                for distance in [-30.0, 0.0, 30.0, 500.0, 999.0]]
+
+    @classmethod
+    def setUpClass(cls):
+        # Use a copy of the shared object, without its BallTree.
+        cls.data = copy.copy(_shared_data())
+        cls.data._tree = None
+
+    # Compare the counties found with a distance calculation to every county.
+    def check_requests(self, data: CovidData):
+        results = _without_results(data).compute_stats_batch(self.requests, "cases")
+        data = _without_results(data)
+        for request, result in zip(self.requests, results):
+            origin_index = data.find_origin(request)
+            origin = (data._lat_rad[origin_index], data._lon_rad[origin_index])
+            dist = haversine_vector(origin, data._lat_rad, data._lon_rad,
+                                    data._cos_lat)
+            expected = np.flatnonzero(dist <= request.distance)
+
+            hits, hit_dist = data.find_in_range(origin, request.distance)
+            np.testing.assert_array_equal(hits, expected)
+            np.testing.assert_allclose(hit_dist, dist[expected], rtol=1e-5, atol=1e-3)
+
+            expected = expected[data._has_data[expected]]
+            self.assertEqual(result['fips'], [data._fips[i] for i in expected])
+            self.assertEqual(result['stat_total'],
+                             int(data._stats['cases'][expected].sum()))
+            self.assertEqual(result, data.compute_stats(request, "cases"))
+
+    def test_ball_tree(self):
+        if data_functions.import_ball_tree() is None:
+            self.skipTest("scikit-learn is not installed")
+        data = copy.copy(self.data)
+        data.build_tree()
+        self.check_requests(data)
+
+    def test_numpy(self):
+        with mock.patch.object(data_functions, 'import_find_in_range_numba',
+                               lambda: None):
+            self.check_requests(self.data)
+
+    def test_numba(self):
+        if data_functions.import_find_in_range_numba() is None:
+            self.skipTest("numba is not installed")
+        self.check_requests(self.data)
+
+# Tests of the cache files of the parsed csv files.
+class TestCsvCache(unittest.TestCase):
+    dtypes = {'county': str, 'cases': 'float64'}
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.csv_path = join(self.dir.name, 'counties.csv')
+        self.write_csv(['Alameda,10', 'Marin,20'])
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def write_csv(self, rows: list) -> None:
+        with open(self.csv_path, 'w') as f:
+            f.write('\n'.join(['county,cases'] + rows) + '\n')
+
+    # Read the csv file as a new process would (without the in-memory cache).
+    def read(self):
+        data_functions._read_csv_cached.cache_clear()
+        return data_functions.read_csv_cached(self.csv_path, self.dtypes)
+
+    def cache_files(self) -> list:
+        return glob.glob(self.csv_path + '.*')
+
+    # Test that an empty (e.g. partially written) cache file is replaced.
+    def check_empty_cache_file(self):
+        expected = self.read()
+        for path in self.cache_files():
+            open(path, 'w').close()
+        self.assertTrue(self.read().equals(expected))
+        self.assertTrue(self.read().equals(expected))
+
+    def test_empty_cache_file(self):
+        self.check_empty_cache_file()
+
+    def test_empty_pickle_cache_file(self):
+        with mock.patch.object(data_functions, 'pacsv', None):
+            self.check_empty_cache_file()
+
+    # Test that a csv replaced by a copy with an older modification time
+    # does not use the cache file of the previous csv.
+    def test_older_csv(self):
+        self.read()
+        csv_mtime_ns = os.stat(self.csv_path).st_mtime_ns
+        self.write_csv(['Alameda,10'])
+        os.utime(self.csv_path, ns=(csv_mtime_ns - 10**9, csv_mtime_ns - 10**9))
+        self.assertEqual(self.read()['county'].tolist(), ['Alameda'])
+        self.assertEqual(len(self.cache_files()), 1)
+
+class TestHaversine(unittest.TestCase):
+
+    # Test that the vectorized distances match the single pair version.
+    def test_vector(self):
+        origin = (37.7749, -122.4194)
+        lat = np.array([37.7749, 34.0522, 40.7128, 21.3069, 61.2181])
+        lon = np.array([-122.4194, -118.2437, -74.0060, -157.8583, -149.9003])
+        expected = [haversine(origin, destination) for destination in zip(lat, lon)]
+        result = haversine_vector(np.radians(origin), np.radians(lat),
+                                  np.radians(lon), np.cos(np.radians(lat)))
+        np.testing.assert_allclose(result, expected, rtol=1e-3, atol=1e-6)
         
 
 if __name__ == '__main__':